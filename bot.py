@@ -1,20 +1,32 @@
 import os
+import io
+import re
 import sys
 import logging
 import asyncio
-import json
+import contextlib
+import functools
+import hashlib
 from datetime import datetime
+from urllib.parse import urlparse
 from dotenv import load_dotenv
-from telegram import Update
-from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes
-from selenium import webdriver
-from selenium.webdriver.chrome.options import Options
-from selenium.webdriver.common.by import By
-from selenium.webdriver.support.ui import WebDriverWait
-from selenium.webdriver.support import expected_conditions as EC
+from telegram import InputFile, Update
+from telegram.error import BadRequest
+from telegram.ext import AIORateLimiter, Application, CommandHandler, MessageHandler, filters, ContextTypes
+from playwright.async_api import async_playwright, Error as PlaywrightError, TimeoutError as PlaywrightTimeoutError
 import aiohttp
+import orjson
+import redis.asyncio as aioredis
+from redis.exceptions import RedisError
 import time
-from webdriver_manager.chrome import ChromeDriverManager
+import numpy as np
+from cachetools import LRUCache, TTLCache
+from PIL import Image
+
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
 
 # Configuration
 load_dotenv()
@@ -35,8 +47,42 @@ COINGECKO_API_URL = "https://api.coingecko.com/api/v3"
 BUBBLEMAPS_API_KEY = os.getenv('BUBBLEMAPS_API_KEY')
 COINGECKO_API_KEY = os.getenv('COINGECKO_API_KEY')
 
-# Chain mappings for CoinGecko
-CHAIN_TO_PLATFORM = {
+# How long API responses are reused before refetching (seconds).
+# Bubblemaps data only changes every few hours; prices move faster
+MARKET_DATA_TTL = int(os.getenv('MARKET_DATA_TTL', '300'))
+TOKEN_INFO_TTL = int(os.getenv('TOKEN_INFO_TTL', '3600'))
+UNSUPPORTED_TOKEN_TTL = 600
+
+# Rendered bubble maps are reused for this long (seconds), keeping at most
+# this many bytes of images in memory (0 turns the image cache off)
+SCREENSHOT_TTL = 600
+SCREENSHOT_CACHE_BYTES = int(os.getenv('SCREENSHOT_CACHE_MB', '64')) * 1024 * 1024
+
+# Number of bubble map pages rendered at the same time
+BROWSER_POOL_SIZE = int(os.getenv('BROWSER_POOL_SIZE', '2'))
+
+# Optional: Redis used to share uploaded bubble maps between bot instances
+REDIS_URL = os.getenv('REDIS_URL')
+# Seconds to wait on Redis before giving up; it's only a shortcut, so a slow
+# or unreachable server must never hold up a request for long
+REDIS_TIMEOUT = 0.5
+
+# Optional: public HTTPS URL Telegram should push updates to. When set the bot
+# serves a webhook on WEBHOOK_PORT instead of long-polling
+WEBHOOK_URL = os.getenv('WEBHOOK_URL')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', '8443'))
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET') or None
+
+# Optional: Chromium binary to use instead of the one bundled with Playwright
+CHROMIUM_PATH = os.getenv('CHROMIUM_PATH') or None
+
+# How long CoinGecko calls are skipped after it rate-limits us or stops
+# answering (seconds), when it doesn't send a Retry-After itself
+COINGECKO_BACKOFF = 60
+COINGECKO_MAX_TIMEOUTS = 3
+
+# Supported chains: short name (as used by Bubblemaps) -> CoinGecko platform
+CHAINS = {
     'eth': 'ethereum',
     'bsc': 'binance-smart-chain',
     'ftm': 'fantom',
@@ -46,31 +92,8 @@ CHAIN_TO_PLATFORM = {
     'base': 'base'
 }
 
-# Chain mappings for Bubblemaps
-CHAIN_TO_BUBBLEMAPS = {
-    'eth': 'ethereum',
-    'bsc': 'bsc',
-    'ftm': 'fantom',
-    'avax': 'avalanche',
-    'poly': 'polygon',
-    'arbi': 'arbitrum',
-    'base': 'base'
-}
-
-def debug_api_response(name, data, level="info"):
-    """Log API response data in a readable format"""
-    logger.info(f"--- {name} API Response ---")
-    if level == "debug":
-        logger.info(f"Full response: {json.dumps(data, indent=2)}")
-    elif isinstance(data, dict):
-        for key, value in data.items():
-            if isinstance(value, dict):
-                logger.info(f"{key}: {json.dumps(value, indent=2)}")
-            else:
-                logger.info(f"{key}: {value}")
-    else:
-        logger.info(f"Data: {data}")
-    logger.info("------------------------")
+# A full EVM address (input is lowercased before matching)
+ADDR_RE = re.compile(r'0x[0-9a-f]{40}')
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Handle /start command."""
@@ -82,185 +105,492 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         "Example: 0x1234... eth"
     )
 
-async def get_market_data(addr: str, chain: str) -> dict:
+async def fetch_json(session: aiohttp.ClientSession, url: str):
+    """GET a URL and return the decoded JSON body, or None on a non-200 response."""
+    async with session.get(url) as resp:
+        if resp.status != 200:
+            logger.warning("%s returned status %s", url, resp.status)
+            return None
+        return orjson.loads(await resp.read())
+
+# Calls currently running, keyed by (function name, chain, address).
+# Each entry is [task, number of callers waiting on it]
+_inflight = {}
+
+def single_flight(fetch):
+    """Let concurrent callers asking for the same token share one in-flight call"""
+    @functools.wraps(fetch)
+    async def wrapper(addr: str, chain: str, *args):
+        key = (fetch.__name__, chain, addr)
+        entry = _inflight.get(key)
+        if entry is None:
+            entry = _inflight[key] = [asyncio.ensure_future(fetch(addr, chain, *args)), 0]
+            entry[0].add_done_callback(lambda _: _inflight.pop(key, None) if _inflight.get(key) is entry else None)
+        task = entry[0]
+        entry[1] += 1
+        try:
+            # Shielded so one caller giving up doesn't cancel the others' result
+            return await asyncio.shield(task)
+        finally:
+            entry[1] -= 1
+            # Every caller gave up, so stop the work instead of finishing it for nobody
+            if entry[1] == 0 and not task.done():
+                if _inflight.get(key) is entry:
+                    del _inflight[key]
+                task.cancel()
+    return wrapper
+
+def ttl_cached(ttl: int, maxsize: int = 1024, missing: TTLCache = None):
+    """Cache a per-token fetcher's results, falling back to the last good value on errors"""
+    # A fetcher returns {} rather than None when the API says the token doesn't
+    # exist; unless stale data is served instead, those go into `missing`
+    def decorator(fetch):
+        fresh = TTLCache(maxsize=maxsize, ttl=ttl)
+        # Last good result per token with no expiry, served when the API fails
+        stale = LRUCache(maxsize=maxsize)
+
+        # Misses go through single_flight so concurrent requests share one fetch
+        @single_flight
+        @functools.wraps(fetch)
+        async def load(addr: str, chain: str, session: aiohttp.ClientSession):
+            key = f"{chain}:{addr}"
+            try:
+                result = await fetch(addr, chain, session)
+            except Exception:
+                if key in stale:
+                    logger.warning("%s failed for %s, serving stale data", fetch.__name__, key, exc_info=True)
+                    return stale[key]
+                raise
+            if result:
+                fresh[key] = stale[key] = result
+            elif key in stale:
+                logger.warning("%s returned nothing for %s, serving stale data", fetch.__name__, key)
+                return stale[key]
+            elif result is not None and missing is not None:
+                missing[key] = True
+            return result
+
+        @functools.wraps(fetch)
+        async def wrapper(addr: str, chain: str, session: aiohttp.ClientSession):
+            # Addresses are case-insensitive, so 0xAbC and 0xabc share an entry
+            addr = addr.lower()
+            result = fresh.get(f"{chain}:{addr}")
+            if result is not None:
+                return result
+            return await load(addr, chain, session)
+        return wrapper
+    return decorator
+
+# CoinGecko is skipped until this time.monotonic() value while it rate-limits us
+_cg_blocked_until = 0.0
+# Timeouts in a row from CoinGecko; enough of them also trips the breaker
+_cg_timeouts = 0
+
+def block_coingecko(seconds: float) -> None:
+    """Stop calling CoinGecko for a while instead of queueing more slow requests"""
+    global _cg_blocked_until
+    _cg_blocked_until = max(_cg_blocked_until, time.monotonic() + seconds)
+    logger.warning("Pausing CoinGecko requests for %.0fs", seconds)
+
+@ttl_cached(MARKET_DATA_TTL, maxsize=4096)
+async def get_market_data(addr: str, chain: str, session: aiohttp.ClientSession) -> dict:
     """Fetch token market data from CoinGecko."""
-    if chain not in CHAIN_TO_PLATFORM:
-        logger.warning(f"Unsupported chain: {chain}")
+    global _cg_timeouts
+    if chain not in CHAINS:
+        logger.warning("Unsupported chain: %s", chain)
+        return {}
+    if time.monotonic() < _cg_blocked_until:
         return {}
         
-    platform = CHAIN_TO_PLATFORM[chain]
+    platform = CHAINS[chain]
     url = f"{COINGECKO_API_URL}/coins/{platform}/contract/{addr}"
     
-    async with aiohttp.ClientSession() as session:
-        try:
-            async with session.get(url, timeout=15) as resp:
-                if resp.status != 200:
-                    logger.warning(f"CoinGecko API returned status {resp.status} for {addr}")
-                    return {}
-                
-                data = await resp.json()
-                market = data.get('market_data', {})
-                result = {
-                    'price': market.get('current_price', {}).get('usd'),
-                    'market_cap': market.get('market_cap', {}).get('usd'),
-                    'volume_24h': market.get('total_volume', {}).get('usd'),
-                    'price_change_24h': market.get('price_change_percentage_24h')
-                }
-                return result
-                
-        except asyncio.TimeoutError:
-            logger.error(f"Timeout getting market data for {addr}")
-            return {}
-        except Exception as e:
-            logger.error(f"Market data error: {e}", exc_info=True)
-            return {}
-
-async def get_token_info(contract_address: str, chain: str = 'eth') -> dict:
-    """Gets all the important information about a token, like who owns it and how it's distributed"""
-    async with aiohttp.ClientSession() as session:
-        # Get token's metadata first
-        metadata_url = f"{BUBBLEMAPS_API_URL}/map-metadata?token={contract_address}&chain={chain}"
-        async with session.get(metadata_url) as response:
-            if response.status != 200:
-                return None
-            metadata = await response.json()
-            if metadata.get('status') != 'OK':
-                return None
-
-        # Get detailed token data
-        legacy_url = f"{BUBBLEMAPS_API_URL}/map-data?token={contract_address}&chain={chain}"
-        async with session.get(legacy_url) as response:
-            if response.status != 200:
-                return None
-                
-            legacy_data = await response.json()
-            token_data = {
-                'symbol': legacy_data.get('symbol'),
-                'full_name': legacy_data.get('full_name'),
-                'is_nft': legacy_data.get('is_X721', False)
-            }
-            
-            # Get detailed holder information
-            nodes = legacy_data.get('nodes', [])
-            if not nodes:
-                return None
-                
-            token_data['top_holders'] = []
-            for node in nodes[:5]:  # Get top 5 holders
-                # Extract name from the node data
-                name = node.get('name', '')
-                if not name:
-                    # Try to get a more descriptive name
-                    if node.get('is_contract', False):
-                        name = "Contract"
-                    else:
-                        # Use address as fallback
-                        address = node.get('address', '')
-                        if address:
-                            name = f"Wallet ({address[:6]}...{address[-4:]})"
-                        else:
-                            name = "Unknown"
-                
-                holder_info = {
-                    'address': node.get('address', 'Unknown'),
-                    'percentage': node.get('percentage', 0),
-                    'amount': node.get('amount', 0),
-                    'is_contract': node.get('is_contract', False),
-                    'name': name
-                }
-                token_data['top_holders'].append(holder_info)
-            
-            # Get metadata information
-            token_data['decentralization_score'] = metadata.get('decentralisation_score')
-            identified_supply = metadata.get('identified_supply', {})
-            token_data['percent_in_cexs'] = identified_supply.get('percent_in_cexs')
-            token_data['contract_holder_percentage'] = identified_supply.get('percent_in_contracts')
-            token_data['last_update'] = metadata.get('dt_update')
-            
-            # Calculate token metrics
-            token_data['holder_count'] = len(nodes)  # Total holders
-            token_data['whale_count'] = sum(1 for n in nodes if n['percentage'] > 1)  # Big holders with >1%
-            
-            # Calculate transaction flow
-            links = legacy_data.get('links', [])
-            total_flow = sum(link['forward'] + link['backward'] for link in links)
-            token_data['total_flow'] = total_flow
+    try:
+        async with session.get(url) as resp:
+            _cg_timeouts = 0
+            if resp.status == 429:
+                try:
+                    retry_after = float(resp.headers.get('Retry-After', COINGECKO_BACKOFF))
+                except ValueError:
+                    retry_after = COINGECKO_BACKOFF
+                block_coingecko(retry_after)
+                return {}
+            if resp.status != 200:
+                logger.warning("CoinGecko API returned status %s for %s", resp.status, addr)
+                return {}
             
-            # Calculate a decentralization score (0-100)
-            # A higher score means the token is more evenly distributed
-            # We look at three things:
-            # 1. How much do the biggest holders own? (Less is better, up to 50 points)
-            # 2. How many different holders are there? (More is better, up to 30 points)
-            # 3. How much is in smart contracts? (Less is better, up to 20 points)
-            score = (
-                max(0, 50 - (token_data.get('top_holders', [])[0]['percentage'] / 2)) +    # Up to 50 points for distribution
-                min(30, len(nodes) / 5) +                      # Up to 30 points for number of holders
-                max(0, 20 - (token_data.get('contract_holder_percentage', 0) / 5))         # Up to 20 points for low contract holdings
-            )
-            token_data['decentralization_score'] = min(100, round(score))
+            data = orjson.loads(await resp.read())
+            market = data.get('market_data', {})
+            result = {
+                'price': market.get('current_price', {}).get('usd'),
+                'market_cap': market.get('market_cap', {}).get('usd'),
+                'volume_24h': market.get('total_volume', {}).get('usd'),
+                'price_change_24h': market.get('price_change_percentage_24h')
+            }
+            return result
             
-            return token_data
-
-async def capture_bubblemap(contract_address: str, chain: str = 'eth') -> str:
-    """Takes a picture of the token's bubble map visualization from the website"""
-    # Set up Chrome options for headless mode
-    options = Options()
-    options.add_argument('--headless=new')
-    options.add_argument('--no-sandbox')
-    options.add_argument('--disable-dev-shm-usage')
-    options.add_argument('--disable-gpu')
-    options.add_argument('--window-size=1920,1080')
+    except asyncio.TimeoutError:
+        logger.error("Timeout getting market data for %s", addr)
+        _cg_timeouts += 1
+        if _cg_timeouts >= COINGECKO_MAX_TIMEOUTS:
+            _cg_timeouts = 0
+            block_coingecko(COINGECKO_BACKOFF)
+        return {}
+    except Exception as e:
+        logger.error("Market data error: %s", e, exc_info=True)
+        return {}
+
+def summarize_holder(node: dict) -> dict:
+    """Pick out the fields we show for a holder, with a readable name"""
+    # Extract name from the node data
+    name = node.get('name', '')
+    if not name:
+        # Try to get a more descriptive name
+        if node.get('is_contract', False):
+            name = "Contract"
+        else:
+            # Use address as fallback
+            address = node.get('address', '')
+            if address:
+                name = f"Wallet ({address[:6]}...{address[-4:]})"
+            else:
+                name = "Unknown"
     
-    try:
-        logger.info(f"Starting screenshot capture for {contract_address}")
-        # Use Chrome directly, not the Remote WebDriver
-        driver = webdriver.Chrome(options=options)
+    return {
+        'address': node.get('address', 'Unknown'),
+        'percentage': node.get('percentage', 0),
+        'amount': node.get('amount', 0),
+        'is_contract': node.get('is_contract', False),
+        'name': name
+    }
+
+# Tokens Bubblemaps answered for but has no map of, so repeat requests don't
+# render a page that will never draw one. API failures are not recorded here.
+# Kept short, since a token can get its map soon after launch
+UNSUPPORTED_TOKENS = TTLCache(maxsize=4096, ttl=UNSUPPORTED_TOKEN_TTL)
+
+@ttl_cached(TOKEN_INFO_TTL, maxsize=2048, missing=UNSUPPORTED_TOKENS)
+async def get_token_info(contract_address: str, chain: str, session: aiohttp.ClientSession) -> dict:
+    """Gets all the important information about a token, like who owns it and how it's distributed"""
+    metadata_url = f"{BUBBLEMAPS_API_URL}/map-metadata?token={contract_address}&chain={chain}"
+    legacy_url = f"{BUBBLEMAPS_API_URL}/map-data?token={contract_address}&chain={chain}"
+
+    # Metadata and detailed token data don't depend on each other, so fetch both at once
+    metadata, legacy_data = await asyncio.gather(
+        fetch_json(session, metadata_url),
+        fetch_json(session, legacy_url)
+    )
+    # Check metadata first: when Bubblemaps has no map, map-data usually fails too,
+    # and that should count as "not supported" rather than an API error
+    if metadata is None:
+        return None
+    if metadata.get('status') != 'OK':
+        return {}
+    if legacy_data is None:
+        return None
+
+    token_data = {
+        'symbol': legacy_data.get('symbol'),
+        'full_name': legacy_data.get('full_name'),
+        'is_nft': legacy_data.get('is_X721', False)
+    }
+    
+    # Get detailed holder information
+    nodes = legacy_data.get('nodes', [])
+    if not nodes:
+        return {}
         
-        # Visit the token's page and wait for it to load
+    # Get top 5 holders
+    top_holders = [summarize_holder(node) for node in nodes[:5]]
+    token_data['top_holders'] = top_holders
+    
+    # Get metadata information. Bubblemaps' own score is kept separately from ours below
+    token_data['bubblemaps_score'] = metadata.get('decentralisation_score')
+    identified_supply = metadata.get('identified_supply', {})
+    token_data['percent_in_cexs'] = identified_supply.get('percent_in_cexs')
+    token_data['contract_holder_percentage'] = identified_supply.get('percent_in_contracts')
+    token_data['last_update'] = metadata.get('dt_update')
+    
+    # Calculate token metrics
+    n_nodes = len(nodes)
+    first_pct = top_holders[0]['percentage']
+    token_data['holder_count'] = n_nodes  # Total holders
+    token_data['whale_count'] = sum(1 for node in nodes if node['percentage'] > 1)  # Holders with >1%
+    
+    # Calculate transaction flow
+    links = legacy_data.get('links', [])
+    token_data['total_flow'] = sum(link['forward'] + link['backward'] for link in links)
+    
+    # Calculate a decentralization score (0-100)
+    # A higher score means the token is more evenly distributed
+    # We look at three things:
+    # 1. How much do the biggest holders own? (Less is better, up to 50 points)
+    # 2. How many different holders are there? (More is better, up to 30 points)
+    # 3. How much is in smart contracts? (Less is better, up to 20 points)
+    contract_pct = token_data['contract_holder_percentage'] or 0
+    score = (
+        max(0, 50 - (first_pct / 2)) +           # Up to 50 points for distribution
+        min(30, n_nodes / 5) +                   # Up to 30 points for number of holders
+        max(0, 20 - (contract_pct / 5))          # Up to 20 points for low contract holdings
+    )
+    token_data['decentralization_score'] = min(100, round(score))
+    
+    return token_data
+
+# Third-party resources that don't affect the bubble map canvas
+BLOCKED_RESOURCE_TYPES = {'font', 'image', 'media'}
+BLOCKED_URL_PARTS = ('googletagmanager', 'google-analytics', 'doubleclick', 'sentry', 'hotjar')
+
+async def block_unneeded_requests(route) -> None:
+    """Abort analytics, trackers and third-party media so the map loads faster"""
+    request = route.request
+    if any(part in request.url for part in BLOCKED_URL_PARTS) or (
+        request.resource_type in BLOCKED_RESOURCE_TYPES and 'bubblemaps' not in request.url
+    ):
+        await route.abort()
+    else:
+        await route.continue_()
+
+class BrowserPool:
+    """One shared headless Chromium; each capture gets its own throwaway context"""
+
+    def __init__(self):
+        self._launch_lock = asyncio.Lock()
+        self._playwright = None
+        self._browser = None
+
+    async def start(self) -> None:
+        """Launch the browser up front so requests never wait on a cold start"""
+        self._playwright = await async_playwright().start()
+        await self._launch()
+
+    async def _launch(self) -> None:
+        self._browser = await self._playwright.chromium.launch(
+            executable_path=CHROMIUM_PATH,
+            headless=True,
+            # Playwright already passes the usual headless flags (no extensions,
+            # sync, translate, first-run or background networking); also skip
+            # proxy auto-detection on every connection
+            args=[
+                '--no-sandbox',
+                '--disable-dev-shm-usage',
+                '--disable-gpu',
+                '--proxy-server=direct://',
+                '--proxy-bypass-list=*'
+            ]
+        )
+        logger.info("Started headless Chromium")
+
+    @contextlib.asynccontextmanager
+    async def page(self):
+        """Open a fresh page in its own context, closing it when done"""
+        async with self._launch_lock:
+            # Relaunch if the browser crashed since the last capture
+            if not self._browser.is_connected():
+                logger.warning("Chromium disconnected, relaunching")
+                await self._launch()
+        context = await self._browser.new_context(viewport={'width': 1920, 'height': 1080})
+        # Everything after the context exists sits in the try, so a failure or a
+        # cancelled render still closes it
+        try:
+            await context.route('**/*', block_unneeded_requests)
+            yield await context.new_page()
+        finally:
+            await context.close()
+
+    async def close(self) -> None:
+        """Shut down the browser and Playwright"""
+        if self._browser is not None:
+            await self._browser.close()
+        if self._playwright is not None:
+            await self._playwright.stop()
+
+# Telegram file_id of the last uploaded bubble map per token, so repeat
+# requests can be sent without rendering or uploading again
+PHOTO_FILE_IDS = TTLCache(maxsize=1024, ttl=SCREENSHOT_TTL)
+
+# Recently rendered screenshots, for when the upload itself failed or Telegram rejected the cached file_id.
+# Bounded by total image bytes rather than entry count, least recently used go first
+SCREENSHOT_CACHE = TTLCache(maxsize=SCREENSHOT_CACHE_BYTES, ttl=SCREENSHOT_TTL, getsizeof=len)
+
+# True once the bubble map canvas holds real pixels rather than a blank surface.
+# The canvas is copied into a small throwaway probe and sampled there: calling
+# getContext on the app's own canvas could claim it before its WebGL renderer
+# does, and copying works the same for 2D and WebGL canvases
+BUBBLEMAP_RENDERED_JS = """() => {
+    const el = document.querySelector('.bubblemaps-canvas');
+    if (!el) return false;
+    // SVG-drawn maps are ready once their bubbles exist
+    if (el.querySelectorAll('svg circle').length >= 5) return true;
+    const canvas = el.tagName === 'CANVAS' ? el : el.querySelector('canvas');
+    if (!canvas || !canvas.width || !canvas.height) return false;
+    const probe = document.createElement('canvas');
+    probe.width = probe.height = 32;
+    const ctx = probe.getContext('2d');
+    try {
+        ctx.drawImage(canvas, 0, 0, probe.width, probe.height);
+        const pixels = ctx.getImageData(0, 0, probe.width, probe.height).data;
+        for (let i = 3; i < pixels.length; i += 4) {
+            if (pixels[i] !== 0) return true;
+        }
+    } catch (e) {
+        return false;
+    }
+    return false;
+}"""
+
+# Visible area of the bubble map, so the screenshot can skip the page chrome
+BUBBLEMAP_RECT_JS = """() => {
+    const el = document.querySelector('.bubblemaps-canvas');
+    if (!el) return null;
+    const r = el.getBoundingClientRect();
+    const x = Math.max(0, r.left), y = Math.max(0, r.top);
+    const width = Math.min(r.right, window.innerWidth) - x;
+    const height = Math.min(r.bottom, window.innerHeight) - y;
+    return width > 0 && height > 0 ? {x, y, width, height} : null;
+}"""
+
+def screenshot_cache_key(contract_address: str, chain: str) -> str:
+    """Stable cache key for a token's bubble map"""
+    return hashlib.sha256(f"{chain}:{contract_address}".encode()).hexdigest()
+
+async def get_photo_file_id(redis_client, contract_address: str, chain: str):
+    """Find a recently uploaded bubble map for a token, checking Redis when configured"""
+    cache_key = screenshot_cache_key(contract_address, chain)
+    file_id = PHOTO_FILE_IDS.get(cache_key)
+    if file_id is None and redis_client is not None:
+        try:
+            file_id = await redis_client.get(f"bm:fileid:{chain}:{contract_address}")
+        except RedisError as e:
+            logger.warning("Redis lookup failed: %s", e)
+        if file_id is not None:
+            PHOTO_FILE_IDS[cache_key] = file_id
+    return file_id
+
+async def store_photo_file_id(redis_client, contract_address: str, chain: str, file_id: str) -> None:
+    """Remember an uploaded bubble map so any worker can resend it without rendering"""
+    PHOTO_FILE_IDS[screenshot_cache_key(contract_address, chain)] = file_id
+    if redis_client is not None:
+        try:
+            await redis_client.setex(f"bm:fileid:{chain}:{contract_address}", SCREENSHOT_TTL, file_id)
+        except RedisError as e:
+            logger.warning("Redis write failed: %s", e)
+
+async def forget_photo_file_id(redis_client, contract_address: str, chain: str) -> None:
+    """Drop a bubble map file_id that Telegram refused, locally and in Redis"""
+    PHOTO_FILE_IDS.pop(screenshot_cache_key(contract_address, chain), None)
+    if redis_client is not None:
+        try:
+            await redis_client.delete(f"bm:fileid:{chain}:{contract_address}")
+        except RedisError as e:
+            logger.warning("Redis delete failed: %s", e)
+
+def is_blank_screenshot(image: bytes, threshold: float = 0.95) -> bool:
+    """Check whether a screenshot is almost entirely white"""
+    with Image.open(io.BytesIO(image)) as img:
+        # Every 10th pixel in each direction is plenty to spot an empty page
+        pixels = np.asarray(img.convert('RGB'))[::10, ::10]
+    white_ratio = float((pixels > 240).all(axis=-1).mean())
+    return white_ratio > threshold
+
+def compress_screenshot(image: bytes, max_size=(1280, 720), min_bytes: int = 200_000) -> bytes:
+    """Shrink a screenshot to a JPEG that Telegram won't need to downscale"""
+    # Small images upload quickly as they are
+    if len(image) < min_bytes:
+        return image
+    with Image.open(io.BytesIO(image)) as img:
+        img.thumbnail(max_size)
+        buf = io.BytesIO()
+        img.convert('RGB').save(buf, 'JPEG', quality=85, optimize=True)
+    return buf.getvalue()
+
+# Bounds how many captures run at once, rendering and post-processing included
+CAPTURE_SLOTS = asyncio.Semaphore(BROWSER_POOL_SIZE)
+
+@single_flight
+async def capture_bubblemap(contract_address: str, chain: str, pool: BrowserPool) -> bytes:
+    """Takes a picture of the token's bubble map visualization from the website, as image bytes"""
+    # Holder distribution changes slowly, so a recent render is good enough
+    cache_key = screenshot_cache_key(contract_address, chain)
+    photo = SCREENSHOT_CACHE.get(cache_key)
+    if photo is not None:
+        logger.info("Using cached screenshot for %s", contract_address)
+        return photo
+
+    # Each render holds a full page plus decoded images in memory, so extra
+    # requests queue here instead of piling more work onto the host
+    async with CAPTURE_SLOTS:
+        logger.info("Starting screenshot capture for %s", contract_address)
         url = f"{BUBBLEMAPS_APP_URL}/{chain}/token/{contract_address}"
-        logger.info(f"Loading URL: {url}")
-        driver.get(url)
-        logger.info("Waiting for page to load...")
-        
-        # Wait for specific elements to be visible
         try:
-            WebDriverWait(driver, 10).until(
-                EC.presence_of_element_located((By.CLASS_NAME, "bubblemaps-canvas"))
-            )
-            # Additional wait to ensure visualization is rendered
-            await asyncio.sleep(5)
+            async with pool.page() as page:
+                # Visit the token's page and wait for it to load
+                logger.info("Loading URL: %s", url)
+                # Don't wait for every script and stylesheet; the render check below
+                # waits for what actually matters
+                await page.goto(url, wait_until='domcontentloaded')
+                logger.info("Waiting for page to load...")
+
+                # Poll until the map has actually been drawn instead of sleeping a fixed time
+                try:
+                    await page.wait_for_function(BUBBLEMAP_RENDERED_JS, polling=500, timeout=30000)
+                    rendered = True
+                except PlaywrightTimeoutError as e:
+                    logger.warning("Timeout waiting for elements: %s", e)
+                    rendered = False
+                except PlaywrightError as e:
+                    # The check itself broke; give the map a moment and let the blank check decide
+                    logger.warning("Render check failed: %s", e)
+                    await asyncio.sleep(2)
+                    rendered = False
+
+                # Once drawn, grab just the map as a JPEG straight from Chromium;
+                # otherwise keep the whole page so it can be checked for blankness
+                clip = await page.evaluate(BUBBLEMAP_RECT_JS) if rendered else None
+                if clip is not None:
+                    raw = await page.screenshot(type='jpeg', quality=80, clip=clip)
+                else:
+                    raw = await page.screenshot()
         except Exception as e:
-            logger.warning(f"Timeout waiting for elements: {e}")
-        
-        # Save the bubble map as an image
-        screenshot_path = f"bubblemap_{contract_address}.png"
-        logger.info(f"Taking screenshot and saving to {screenshot_path}")
-        driver.save_screenshot(screenshot_path)
-        logger.info("Screenshot saved successfully")
-        return screenshot_path
-    except Exception as e:
-        logger.error(f"Error during screenshot capture: {e}")
-        raise
-    finally:
-        # Always close the browser when we're done
-        if 'driver' in locals():
-            driver.quit()
-
-def format_number(value, decimal_places=2, is_price=False):
-    """Format numeric values into a readable currency format."""
-    logger.info(f"Formatting number: {value}, is_price={is_price}")
-    if value is None:
+            logger.error("Error during screenshot capture: %s", e)
+            raise
+
+        # The readiness check already proved the canvas has content; only
+        # inspect the pixels when it timed out
+        if not rendered and await asyncio.to_thread(is_blank_screenshot, raw):
+            raise RuntimeError(f"Bubble map for {contract_address} did not render")
+        photo = await asyncio.to_thread(compress_screenshot, raw)
+        logger.info("Screenshot taken successfully (%s -> %s bytes)", len(raw), len(photo))
+    # cachetools refuses a single item bigger than the whole budget (or any, at 0)
+    if len(photo) <= SCREENSHOT_CACHE.maxsize:
+        SCREENSHOT_CACHE[cache_key] = photo
+    return photo
+
+def format_money(value) -> str:
+    """Format a dollar amount like market cap or volume."""
+    if not isinstance(value, (int, float)):
         return 'N/A'
-    try:
-        if is_price and value < 0.01:
-            return f"${value:,.8f}"
-        return f"${value:,.{decimal_places}f}"
-    except (TypeError, ValueError) as e:
-        logger.error(f"Error formatting number {value}: {e}")
+    return f"${value:,.2f}"
+
+def format_price(value) -> str:
+    """Format a token price, keeping more decimals for sub-cent tokens."""
+    if not isinstance(value, (int, float)):
         return 'N/A'
+    if value < 0.01:
+        return f"${value:,.8f}"
+    return f"${value:,.2f}"
+
+def holder_lines(idx, holder):
+    """Yield the three caption lines describing one top holder."""
+    address = holder.get('address', 'Unknown')
+    contract_status = '📜' if holder.get('is_contract', False) else '👤'
+    yield f"{idx}. {contract_status} {holder.get('name', 'Unknown')}"
+    yield f"   └ {address[:8]}...{address[-4:]}"
+    yield f"   └ {holder.get('percentage', 0):.2f}% ({holder.get('amount', 0)} tokens)"
 
 async def handle_contract_address(update: Update, context: ContextTypes.DEFAULT_TYPE):
     processing_message = await update.message.reply_text("⏳ Processing your request...")
+    screenshot_task = None
     
     try:
         text = update.message.text.lower().strip()
@@ -273,35 +603,54 @@ async def handle_contract_address(update: Update, context: ContextTypes.DEFAULT_
         addr = parts[0]
         chain = parts[1] if len(parts) > 1 else 'eth'
         
-        if not addr.startswith('0x') or len(addr) != 42:
+        # Reject malformed input before spending any network calls on it
+        if not ADDR_RE.fullmatch(addr):
             await processing_message.edit_text("❌ Invalid address format")
             return
             
-        if chain not in CHAIN_TO_PLATFORM:
-            await processing_message.edit_text(f"❌ Invalid chain. Supported: {', '.join(CHAIN_TO_PLATFORM.keys())}")
+        if chain not in CHAINS:
+            await processing_message.edit_text(f"❌ Invalid chain. Supported: {', '.join(CHAINS.keys())}")
             return
         
-        logger.info(f"Processing token request: {addr} on {chain}")
+        if f"{chain}:{addr}" in UNSUPPORTED_TOKENS:
+            await processing_message.edit_text("❌ Token not found or not supported on Bubblemaps")
+            return
         
-        try:
-            token_info = await get_token_info(addr, chain)
-            market_data = await get_market_data(addr, chain)
-        except Exception as e:
-            logger.error(f"Data fetch error: {e}", exc_info=True)
-            token_info, market_data = None, {}
+        logger.info("Processing token request: %s on %s", addr, chain)
         
-        if token_info is None:
+        # Reuse the last uploaded bubble map for this token if it's still fresh.
+        # Otherwise start rendering right away so it overlaps with the API calls
+        redis_client = context.application.bot_data.get('redis')
+        cached_file_id = await get_photo_file_id(redis_client, addr, chain)
+        if cached_file_id is None:
+            screenshot_task = asyncio.create_task(
+                capture_bubblemap(addr, chain, context.application.bot_data['browser_pool'])
+            )
+        
+        session = context.application.bot_data['session']
+        token_info, market_data = await asyncio.gather(
+            get_token_info(addr, chain, session),
+            get_market_data(addr, chain, session),
+            return_exceptions=True
+        )
+        # A failure in one source shouldn't throw away the other's data
+        if isinstance(token_info, Exception):
+            logger.error("Token info fetch error: %s", token_info, exc_info=token_info)
+            token_info = None
+        if isinstance(market_data, Exception):
+            logger.error("Market data fetch error: %s", market_data, exc_info=market_data)
+            market_data = {}
+        
+        if not token_info:
             await processing_message.edit_text("❌ Token not found or not supported on Bubblemaps")
             return
-            
-        screenshot_task = asyncio.create_task(capture_bubblemap(addr, chain))
         
         full_name = token_info.get('full_name', 'Unknown')
         symbol = token_info.get('symbol', 'N/A')
         is_nft = token_info.get('is_nft', False)
         token_type = "NFT Collection" if is_nft else "Token"
         
-        analysis = f"📊 {token_type} Analysis for {full_name} ({symbol})\n\n"
+        lines = [f"📊 {token_type} Analysis for {full_name} ({symbol})", ""]
         
         if market_data:
             price = market_data.get('price')
@@ -309,75 +658,84 @@ async def handle_contract_address(update: Update, context: ContextTypes.DEFAULT_
             volume_24h = market_data.get('volume_24h')
             price_change_24h = market_data.get('price_change_24h')
             
-            analysis += "Market Data:\n"
-            analysis += f"- Price: {format_number(price, is_price=True)}\n"
-            analysis += f"- Market Cap: {format_number(market_cap)}\n"
-            analysis += f"- 24h Volume: {format_number(volume_24h)}\n"
+            lines.append("Market Data:")
+            lines.append(f"- Price: {format_price(price)}")
+            lines.append(f"- Market Cap: {format_money(market_cap)}")
+            lines.append(f"- 24h Volume: {format_money(volume_24h)}")
             if price_change_24h is not None:
-                analysis += f"- 24h Change: {price_change_24h:+.2f}%\n"
+                lines.append(f"- 24h Change: {price_change_24h:+.2f}%")
             else:
-                analysis += "- 24h Change: N/A\n"
-            analysis += "\n"
+                lines.append("- 24h Change: N/A")
+            lines.append("")
         else:
-            analysis += "Market Data: N/A\n\n"
+            lines.extend(["Market Data: N/A", ""])
         
         decentralization_score = token_info.get('decentralization_score')
         percent_in_cexs = token_info.get('percent_in_cexs')
         percent_in_contracts = token_info.get('contract_holder_percentage')
         
-        analysis += "Decentralization Metrics:\n"
+        lines.append("Decentralization Metrics:")
         if decentralization_score is not None:
-            analysis += f"- Score: {decentralization_score}/100\n"
+            lines.append(f"- Score: {decentralization_score}/100")
         else:
-            analysis += "- Score: N/A\n"
+            lines.append("- Score: N/A")
         if percent_in_cexs is not None:
-            analysis += f"- Percent in CEXs: {percent_in_cexs:.1f}%\n"
+            lines.append(f"- Percent in CEXs: {percent_in_cexs:.1f}%")
         else:
-            analysis += "- Percent in CEXs: N/A\n"
+            lines.append("- Percent in CEXs: N/A")
         if percent_in_contracts is not None:
-            analysis += f"- Percent in Contracts: {percent_in_contracts:.1f}%\n"
+            lines.append(f"- Percent in Contracts: {percent_in_contracts:.1f}%")
         else:
-            analysis += "- Percent in Contracts: N/A\n"
-        analysis += "\n"
+            lines.append("- Percent in Contracts: N/A")
+        lines.append("")
         
-        analysis += "Top 5 Holders:\n"
+        lines.append("Top 5 Holders:")
         top_holders = token_info.get('top_holders', [])
         if top_holders:
-            for idx, holder in enumerate(top_holders, 1):
-                percentage = holder.get('percentage', 0)
-                amount = holder.get('amount', 0)
-                name = holder.get('name', 'Unknown')
-                address = holder.get('address', 'Unknown')
-                is_contract = holder.get('is_contract', False)
-                contract_status = '📜' if is_contract else '👤'
-                
-                analysis += (
-                    f"{idx}. {contract_status} {name}\n"
-                    f"   └ {address[:8]}...{address[-4:]}\n"
-                    f"   └ {percentage:.2f}% ({amount} tokens)\n"
-                )
+            lines.extend(
+                line
+                for idx, holder in enumerate(top_holders, 1)
+                for line in holder_lines(idx, holder)
+            )
         else:
-            analysis += "No holder data available\n"
+            lines.append("No holder data available")
         
         last_update = token_info.get('last_update')
-        analysis += f"\nLast Update: {last_update}\n"
+        lines.extend(["", f"Last Update: {last_update}", ""])
         
-        analysis += f"\n🔗 View on Bubblemaps: {BUBBLEMAPS_APP_URL}/{chain}/token/{addr}"
+        lines.append(f"🔗 View on Bubblemaps: {BUBBLEMAPS_APP_URL}/{chain}/token/{addr}")
+        analysis = "\n".join(lines)
         
         try:
-            screenshot_path = await asyncio.wait_for(screenshot_task, timeout=60)
-            await update.message.reply_photo(
-                photo=open(screenshot_path, 'rb'),
-                caption=analysis
-            )
-            os.remove(screenshot_path)
+            if cached_file_id is not None:
+                try:
+                    await update.message.reply_photo(photo=cached_file_id, caption=analysis)
+                except BadRequest as e:
+                    # Only a refused file means the id is bad; anything else
+                    # (like an overlong caption) would fail with a new upload too
+                    if 'file' not in e.message.lower():
+                        raise
+                    # Telegram no longer accepts this id; drop it everywhere and render instead
+                    logger.warning("Cached bubble map for %s was rejected: %s", addr, e)
+                    await forget_photo_file_id(redis_client, addr, chain)
+                    cached_file_id = None
+                    screenshot_task = asyncio.create_task(
+                        capture_bubblemap(addr, chain, context.application.bot_data['browser_pool'])
+                    )
+            if cached_file_id is None:
+                photo = await asyncio.wait_for(screenshot_task, timeout=60)
+                # Named so Telegram gets the right content type without sniffing
+                extension = 'png' if photo.startswith(b'\x89PNG') else 'jpg'
+                upload = InputFile(photo, filename=f"bubblemap_{chain}_{addr}.{extension}")
+                message = await update.message.reply_photo(photo=upload, caption=analysis)
+                await store_photo_file_id(redis_client, addr, chain, message.photo[-1].file_id)
         except asyncio.TimeoutError:
             logger.error("Screenshot capture timed out")
             await update.message.reply_text(
                 text=f"⚠️ Could not generate bubble map visualization\n\n{analysis}"
             )
         except Exception as e:
-            logger.error(f"Screenshot error: {e}", exc_info=True)
+            logger.error("Screenshot error: %s", e, exc_info=True)
             await update.message.reply_text(
                 text=f"⚠️ Could not generate bubble map visualization\n\n{analysis}"
             )
@@ -386,17 +744,102 @@ async def handle_contract_address(update: Update, context: ContextTypes.DEFAULT_
         logger.info("Request processing completed successfully")
         
     except Exception as e:
-        logger.error(f"Error processing contract address: {e}", exc_info=True)
+        logger.error("Error processing contract address: %s", e, exc_info=True)
         if 'processing_message' in locals():
             await processing_message.edit_text("❌ An error occurred while processing your request. Please try again later.")
         else:
             await update.message.reply_text("❌ An error occurred while processing your request. Please try again later.")
+    finally:
+        # However the request ended, don't leave a render running that nobody
+        # will send; cancelling it closes its browser page
+        if screenshot_task is not None:
+            if not screenshot_task.done():
+                screenshot_task.cancel()
+            elif not screenshot_task.cancelled() and screenshot_task.exception() is not None:
+                # Read a failure nobody awaited, so asyncio doesn't log it as never retrieved
+                logger.debug("Unused bubble map render failed: %s", screenshot_task.exception())
+
+async def post_init(application: Application) -> None:
+    """Open the shared HTTP session and browser pool once the bot starts."""
+    # One pooled session for all outbound API calls, so repeat requests
+    # reuse keep-alive connections instead of paying a new TCP/TLS handshake
+    connector = aiohttp.TCPConnector(
+        limit=100,
+        limit_per_host=20,
+        ttl_dns_cache=300,
+        keepalive_timeout=30,
+        enable_cleanup_closed=True
+    )
+    application.bot_data['session'] = aiohttp.ClientSession(
+        connector=connector,
+        timeout=aiohttp.ClientTimeout(total=15, connect=5)
+    )
+
+    # Share uploaded bubble maps between bot instances when Redis is available
+    if REDIS_URL:
+        application.bot_data['redis'] = aioredis.from_url(
+            REDIS_URL,
+            decode_responses=True,
+            socket_connect_timeout=REDIS_TIMEOUT,
+            socket_timeout=REDIS_TIMEOUT
+        )
+
+    # Pre-launch Chromium so screenshots skip browser startup
+    pool = BrowserPool()
+    await pool.start()
+    application.bot_data['browser_pool'] = pool
+
+async def post_shutdown(application: Application) -> None:
+    """Close the shared HTTP session, Redis and browsers on shutdown."""
+    session = application.bot_data.pop('session', None)
+    if session is not None:
+        await session.close()
+    redis_client = application.bot_data.pop('redis', None)
+    if redis_client is not None:
+        await redis_client.aclose()
+    pool = application.bot_data.pop('browser_pool', None)
+    if pool is not None:
+        await pool.close()
 
 def main():
-    application = Application.builder().token(TELEGRAM_TOKEN).build()
+    # uvloop's faster event loop, where it's available (not on Windows)
+    if uvloop is not None:
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    application = (
+        Application.builder()
+        .token(TELEGRAM_TOKEN)
+        # Replies get their own, larger connection pool so a burst of photo
+        # uploads can't starve each other or the long-poll for updates
+        .connection_pool_size(64)
+        .pool_timeout(20)
+        .connect_timeout(10)
+        .read_timeout(30)
+        .write_timeout(30)
+        .get_updates_connection_pool_size(4)
+        .get_updates_pool_timeout(30)
+        # Handle updates side by side, so one slow bubble map doesn't hold up
+        # every message behind it; CAPTURE_SLOTS still bounds the browser work
+        .concurrent_updates(True)
+        # Queue outgoing calls locally under Telegram's ~30 messages/s limit
+        # instead of running into 429s during bursts; retry if one slips through
+        .rate_limiter(AIORateLimiter(overall_max_rate=25, overall_time_period=1, max_retries=2))
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+        .build()
+    )
     application.add_handler(CommandHandler("start", start))
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_contract_address))
-    application.run_polling(allowed_updates=Update.ALL_TYPES)
+    if WEBHOOK_URL:
+        application.run_webhook(
+            listen="0.0.0.0",
+            port=WEBHOOK_PORT,
+            url_path=urlparse(WEBHOOK_URL).path.lstrip('/'),
+            webhook_url=WEBHOOK_URL,
+            secret_token=WEBHOOK_SECRET,
+            allowed_updates=Update.ALL_TYPES
+        )
+    else:
+        application.run_polling(allowed_updates=Update.ALL_TYPES)
 
 if __name__ == '__main__':
     try:
@@ -404,5 +847,5 @@ if __name__ == '__main__':
     except KeyboardInterrupt:
         logger.info("Bot stopped by user")
     except Exception as e:
-        logger.error(f"Bot error: {e}", exc_info=True)
+        logger.error("Bot error: %s", e, exc_info=True)
         sys.exit(1)